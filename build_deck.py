@@ -3,25 +3,28 @@ AnkiTect: Intelligent Anki Deck Generator
 ------------------------------------------
 """
 
+from __future__ import annotations
+
 import asyncio
 import hashlib
 import os
 import re
 import time
 import random
-import ssl
 import html
 import json
 import shutil
+import sys
+import argparse
+import base64
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from datetime import datetime
 from pathlib import Path
 
-import edge_tts
-import genanki
-import pandas as pd
-import aiohttp
-from tqdm.asyncio import tqdm as atqdm
+# Важкі залежності (pandas, genanki, edge_tts, aiohttp, tqdm) імпортуються ліниво
+# у тих етапах, яким вони потрібні: закешовані збірки та експорт не чіпають мережевий стек.
 
 # --- 🌍 LANGUAGE SWITCHER ---
 CURRENT_LANG = "EN"
@@ -75,6 +78,14 @@ class Config:
     CSV_FILE: str = "vocabulary.csv"
     REQUEST_DELAY_MIN: float = 0.5  # Минимальная задержка между запросами
     REQUEST_DELAY_MAX: float = 3.5  # Максимальная задержка между запросами
+    WATCH_INTERVAL: float = 0.5  # Період опитування vocabulary.csv у --watch
+    WATCH_DEBOUNCE: float = 1.0  # Скільки файл має бути незмінним перед перезбиранням
+    WATCH_RETRY_INTERVAL: float = 300  # Як часто --watch повторює рядки з недоотриманими медіа
+    STARTUP_BUDGET_MS: int = 200  # Бюджет імпорту build_deck для --startup-report
+    SHARD_DIR: str = "shards"  # Часткові маніфести шардів (--shard / --merge)
+    ANKICONNECT_URL: str = "http://127.0.0.1:8765"  # AnkiConnect для --sync
+    ANKICONNECT_BATCH: int = 50  # Нотаток / медіафайлів на один запит multi
+    BACKUP_DIR: str = "backups"  # Дедуплікуюче сховище знімків колоди
 
 # --- TEMPLATES ---
 class CardTemplates:
@@ -307,6 +318,21 @@ class CardTemplates:
 
 # --- ASSET MANAGER ---
 class AssetManager:
+    _session = None
+
+    @staticmethod
+    async def open_session():
+        """Спільна HTTP-сесія з пулом з'єднань для довгоживучого процесу (--watch)"""
+        import aiohttp
+        if AssetManager._session is None or AssetManager._session.closed:
+            AssetManager._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=False))
+
+    @staticmethod
+    async def close_session():
+        if AssetManager._session is not None:
+            await AssetManager._session.close()
+            AssetManager._session = None
+
     @staticmethod
     def get_path(filename: str) -> str:
         return os.path.join(Config.MEDIA_DIR, filename)
@@ -318,6 +344,96 @@ class AssetManager:
         if match: return match.group(1)
         return str(raw_input).strip().strip('"').strip("'")
 
+    # --- Негативний кеш: відомі збої пропускаються до закінчення TTL ---
+    NEGATIVE_CACHE_FILE = "negative_cache.json"
+    NEGATIVE_TTL = {
+        'not_found': 7 * 24 * 3600,   # 404/410 - ресурсу немає, повтор не допоможе
+        'client_error': 24 * 3600,    # інші 4xx
+        'server_error': 30 * 60,      # 5xx
+        'rate_limited': 15 * 60,      # 429
+        'timeout': 60 * 60,
+        'error': 30 * 60,             # мережеві помилки, порожня відповідь
+    }
+    _negative = None
+    _negative_file = None  # Власний файл шарда (--shard); --merge зливає його в NEGATIVE_CACHE_FILE
+    _inflight = {}
+
+    @staticmethod
+    def classify_status(status: int) -> str:
+        if status == 429: return 'rate_limited'
+        if status in (404, 410): return 'not_found'
+        if status == 408: return 'timeout'
+        if 400 <= status < 500: return 'client_error'
+        return 'server_error'
+
+    @staticmethod
+    def read_negative_file(path: str) -> dict:
+        """Ще чинні (не прострочені) записи негативного кешу з файлу"""
+        if not os.path.exists(path): return {}
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                now = time.time()
+                return {url: e for url, e in json.load(f).items() if e['until'] > now}
+        except:
+            return {}
+
+    @staticmethod
+    def write_negative_file(path: str, entries: dict):
+        # Атомарний запис: читач ніколи не побачить обірваний JSON
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(entries, f, indent=2)
+            os.replace(tmp_path, path)
+        except:
+            pass
+
+    @staticmethod
+    def _negative_cache() -> dict:
+        if AssetManager._negative is None:
+            AssetManager._negative = AssetManager.read_negative_file(AssetManager.NEGATIVE_CACHE_FILE)
+            if AssetManager._negative_file:
+                AssetManager._negative.update(AssetManager.read_negative_file(AssetManager._negative_file))
+        return AssetManager._negative
+
+    @staticmethod
+    def _save_negative_cache():
+        # Кожен процес пише лише свій файл: шард - власний, інакше спільний (як і build_cache.json)
+        path = AssetManager._negative_file or AssetManager.NEGATIVE_CACHE_FILE
+        AssetManager.write_negative_file(path, AssetManager._negative_cache())
+
+    @staticmethod
+    def known_failure(url: str):
+        """Активний запис негативного кешу для url або None"""
+        entry = AssetManager._negative_cache().get(url)
+        if entry and entry['until'] > time.time():
+            return entry
+        return None
+
+    @staticmethod
+    def _record_failure(url: str, kind: str, status: int = None):
+        cache = AssetManager._negative_cache()
+        failures = cache.get(url, {}).get('failures', 0) + 1
+        cache[url] = {'kind': kind, 'status': status, 'failures': failures,
+                      'until': time.time() + AssetManager.NEGATIVE_TTL[kind]}
+        AssetManager._save_negative_cache()
+
+    @staticmethod
+    def _forget_failure(url: str):
+        if AssetManager._negative_cache().pop(url, None) is not None:
+            AssetManager._save_negative_cache()
+
+    @staticmethod
+    async def _single_flight(key, factory):
+        """Однакові запити, що вже в польоті, ділять один запит і його результат"""
+        task = AssetManager._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            AssetManager._inflight[key] = task
+            task.add_done_callback(lambda _: AssetManager._inflight.pop(key, None))
+        # shield: скасування одного з очікувачів (напр. --time-budget) не зриває спільний запит
+        return await asyncio.shield(task)
+
     @staticmethod
     async def download_file(raw_input: str, filename: str, builder=None) -> bool:
         """Загрузка файла с улучшенной обработкой и jitter для имитации пользователя"""
@@ -325,6 +441,24 @@ class AssetManager:
         if not url or len(url) < 5: return False
         path = AssetManager.get_path(filename)
         if os.path.exists(path) and os.path.getsize(path) > 1000: return True
+
+        failure = AssetManager.known_failure(url)
+        if failure:
+            until = datetime.fromtimestamp(failure['until']).strftime("%Y-%m-%d %H:%M")
+            print(f"   ⏭️ Пропуск {filename}: {failure['kind']} (негативний кеш до {until})")
+            return False
+
+        content = await AssetManager._single_flight(('GET', url), lambda: AssetManager._fetch(url, builder))
+        if content is None:
+            print(f"   ✗ Не удалось загрузить: {filename}")
+            return False
+        with open(path, 'wb') as f: f.write(content)
+        return True
+
+    @staticmethod
+    async def _fetch(url: str, builder=None):
+        """Завантажити url з повторами; повертає вміст або None (збій записується в негативний кеш)"""
+        import aiohttp
         
         # Реалистичные headers для имитации браузера
         headers = {
@@ -336,8 +470,7 @@ class AssetManager:
             "Cache-Control": "no-cache",
             "Pragma": "no-cache"
         }
-        
-        ssl_ctx = ssl.create_default_context(); ssl_ctx.check_hostname = False; ssl_ctx.verify_mode = ssl.CERT_NONE
+        failure = ('error', None)
 
         # Экспоненциальный backoff с jitter
         for attempt in range(Config.RETRIES):
@@ -346,34 +479,45 @@ class AssetManager:
                 delay = random.uniform(Config.REQUEST_DELAY_MIN, Config.REQUEST_DELAY_MAX)
                 await asyncio.sleep(delay)
                 
-                connector = aiohttp.TCPConnector(ssl=False)
                 # Увеличенный таймаут для изображений
                 timeout = aiohttp.ClientTimeout(total=Config.IMAGE_TIMEOUT)
-                async with aiohttp.ClientSession(connector=connector, headers=headers, timeout=timeout) as session:
-                    async with session.get(url) as response:
+                # Спільна сесія (--watch) тримає пул з'єднань теплим, інакше - разова сесія
+                session = AssetManager._session or aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=False))
+                try:
+                    async with session.get(url, headers=headers, timeout=timeout) as response:
                         if response.status == 200:
                             content = await response.read()
                             if len(content) > 500:  # Проверка, что файл не пустой
-                                with open(path, 'wb') as f: f.write(content)
                                 if builder:
                                     builder._adjust_concurrency(status_code=200, is_success=True)
-                                return True
+                                AssetManager._forget_failure(url)
+                                return content
+                            failure = ('error', 200)
                         else:
                             # Обработать статус 429 адаптивно
                             if response.status == 429 and builder:
                                 builder._adjust_concurrency(status_code=429)
+                            failure = (AssetManager.classify_status(response.status), response.status)
+                            # 404/410 та інші 4xx не виправляться повтором - не витрачаємо спроби
+                            if failure[0] in ('not_found', 'client_error'):
+                                print(f"   ⚠️ Статус {response.status}, без повторов")
+                                break
                             
                             # Экспоненциальный backoff: 2, 4, 8, 16, 32 секунд
                             backoff = 2 ** attempt
                             print(f"   ⚠️ Статус {response.status}, попытка {attempt+1}/{Config.RETRIES}, ожидание {backoff}с...")
                             await asyncio.sleep(backoff)
+                finally:
+                    if session is not AssetManager._session: await session.close()
             except asyncio.TimeoutError:
+                failure = ('timeout', None)
                 print(f"   ⏱️ Timeout при загрузке, попытка {attempt+1}/{Config.RETRIES}")
                 if builder:
                     builder._adjust_concurrency(is_success=False)
                 if attempt < Config.RETRIES - 1:
                     await asyncio.sleep(2 ** attempt)  # Backoff
             except Exception as e:
+                failure = ('error', None)
                 error_msg = str(e)[:50] if str(e) else "Unknown error"
                 print(f"   ❌ Ошибка загрузки: {error_msg}, попытка {attempt+1}/{Config.RETRIES}")
                 if builder:
@@ -381,8 +525,8 @@ class AssetManager:
                 if attempt < Config.RETRIES - 1:
                     await asyncio.sleep(2 ** attempt)
         
-        print(f"   ✗ Не удалось загрузить: {filename}")
-        return False
+        AssetManager._record_failure(url, *failure)
+        return None
 
     @staticmethod
     def clean_audio_text(text: str) -> str:
@@ -398,27 +542,55 @@ class AssetManager:
         if not text or not text.strip(): return False
         clean_text = AssetManager.clean_audio_text(text)
         path = AssetManager.get_path(filename)
+        # Однакова фраза тим самим голосом синтезується один раз, решта копіює файл
+        source = await AssetManager._single_flight(('TTS', Config.VOICE, volume, clean_text),
+                                                   lambda: AssetManager._synthesize(clean_text, path, volume))
+        if not source: return False
+        if source != path:
+            try: shutil.copyfile(source, path)
+            except OSError: return False
+        return True
+
+    @staticmethod
+    async def _synthesize(clean_text: str, path: str, volume: str):
         try:
+            import edge_tts
             # Небольшая задержка перед TTS для избежания перегрузки
             await asyncio.sleep(random.uniform(0.1, 0.3))
             communicate = edge_tts.Communicate(clean_text, Config.VOICE, volume=volume)
             await communicate.save(path)
-            return True
+            return path
         except Exception as e: 
-            return False
+            return None
 
 # --- DECK BUILDER ---
 class AnkiDeckBuilder:
     CACHE_FILE = "build_cache.json"
+    STATE_FILE = "build_state.json"  # Відбитки зібраних рядків і відкладена робота (--time-budget)
     
-    def __init__(self):
+    def __init__(self, cache_file: str = None):
+        import genanki
         self._ensure_media_dir()
         self.model = self._create_model()
         self.deck = genanki.Deck(Config.DECK_ID, Config.DECK_NAME)
         self.media_files = []
+        self.notes = {}  # guid -> запис нотатки (поля, теги, медіа)
+        self.row_hashes = {}  # guid -> відбиток рядка CSV, з якого зібрано нотатку
+        self.backups_enabled = True  # --watch вимикає після першого експорту: один знімок на сесію
+        self.cache_file = cache_file or self.CACHE_FILE
         self.semaphore = asyncio.Semaphore(Config.CONCURRENCY)
         self.current_concurrency = Config.CONCURRENCY
         self.cache = self._load_cache()
+        self.reset_stats()
+        # Адаптивна паралелізація
+        self.adaptive_stats = {
+            'consecutive_success': 0,
+            'consecutive_failures': 0,
+            'last_status_429': False,
+            'concurrency_adjustments': 0
+        }
+
+    def reset_stats(self):
         self.stats = {
             'words_processed': 0,
             'images_success': 0,
@@ -428,33 +600,29 @@ class AnkiDeckBuilder:
             'audio_sent_success': 0,
             'audio_sent_failed': 0,
             'total_bytes': 0,
+            'rows_pending': 0,
             'start_time': time.time()
         }
-        # Адаптивна паралелізація
-        self.adaptive_stats = {
-            'consecutive_success': 0,
-            'consecutive_failures': 0,
-            'last_status_429': False,
-            'concurrency_adjustments': 0
-        }
 
     def _ensure_media_dir(self):
         if not os.path.exists(Config.MEDIA_DIR): os.makedirs(Config.MEDIA_DIR)
 
     def _load_cache(self) -> dict:
-        """Завантажити кеш вже обробленних файлів"""
-        if os.path.exists(self.CACHE_FILE):
-            try:
-                with open(self.CACHE_FILE, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-            except:
-                return {}
-        return {}
+        """Завантажити кеш вже обробленних файлів (спільний + власний кеш шарда)"""
+        cache = {}
+        for cache_file in dict.fromkeys([self.CACHE_FILE, self.cache_file]):
+            if os.path.exists(cache_file):
+                try:
+                    with open(cache_file, 'r', encoding='utf-8') as f:
+                        cache.update(json.load(f))
+                except:
+                    pass
+        return cache
 
     def _save_cache(self):
         """Зберегти кеш"""
         try:
-            with open(self.CACHE_FILE, 'w', encoding='utf-8') as f:
+            with open(self.cache_file, 'w', encoding='utf-8') as f:
                 json.dump(self.cache, f, indent=2)
         except:
             pass
@@ -520,6 +688,7 @@ class AnkiDeckBuilder:
              self.media_files.append(AssetManager.get_path(filename))
 
     def _create_model(self) -> genanki.Model:
+        import genanki
         front_rec_safe = CardTemplates.FRONT_REC.replace("__LABEL__", Config.LABEL)
         back_rec_safe = CardTemplates.BACK_REC.replace("__FORVO__", Config.FORVO_CODE)
         
@@ -584,6 +753,116 @@ class AnkiDeckBuilder:
         html_out += '</table>'
         return html_out
 
+    @staticmethod
+    def row_uuid(row: pd.Series) -> str:
+        """Стабільний GUID нотатки: md5(слово без артикля + частина мови) + мова"""
+        raw_word = str(row.get('TargetWord', '')).strip()
+        clean_word = re.sub(Config.STRIP_REGEX, '', raw_word, flags=re.IGNORECASE).strip()
+        base_hash = hashlib.md5((clean_word + str(row.get('Part_of_Speech', ''))).encode()).hexdigest()
+        return f"{base_hash}_{CURRENT_LANG}"
+
+    @staticmethod
+    def row_fingerprint(row: pd.Series) -> str:
+        """Відбиток вмісту рядка: змінився рядок - треба перезібрати нотатку"""
+        values = {str(k): str(v) for k, v in row.items()}
+        return hashlib.md5(json.dumps(values, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+    @staticmethod
+    def audio_text_hash(text: str) -> str:
+        return hashlib.md5(f"{Config.VOICE}|{AssetManager.clean_audio_text(text)}".encode()).hexdigest()[:8]
+
+    def _make_note(self, record: dict) -> genanki.Note:
+        import genanki
+        return genanki.Note(model=self.model, fields=record['fields'], tags=record['tags'], guid=record['guid'])
+
+    def add_record(self, record: dict):
+        """Додати готовий запис нотатки до колоди (використовується і злиттям шардів)"""
+        self.notes[record['guid']] = record
+        self.deck.add_note(self._make_note(record))
+        self.media_files.extend(AssetManager.get_path(f) for f in record['media'])
+
+    def _load_state(self) -> dict:
+        """Завантажити стан попередньої збірки (відбитки рядків, відкладена робота)"""
+        if os.path.exists(self.STATE_FILE):
+            try:
+                with open(self.STATE_FILE, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+            except:
+                pass
+        return {'rows': {}, 'pending': []}
+
+    def _save_state(self, state: dict):
+        try:
+            with open(self.STATE_FILE, 'w', encoding='utf-8') as f:
+                json.dump(state, f, indent=2, ensure_ascii=False)
+        except:
+            pass
+
+    def collect_state(self, df: pd.DataFrame, state: dict) -> dict:
+        """Відбитки зібраних рядків df; незавершені рядки - відкладена робота"""
+        rows, pending = {}, []
+        for _, row in df.iterrows():
+            word = str(row.get('TargetWord', '')).strip()
+            if not word: continue
+            guid = self.row_uuid(row)
+            if guid in self.notes:
+                rows[guid] = self.row_fingerprint(row)
+            else:
+                # Старий відбиток лишається - рядок і далі вважатиметься новим/зміненим
+                if guid in state['rows']: rows[guid] = state['rows'][guid]
+                pending.append({'guid': guid, 'word': word})
+        self.stats['rows_pending'] = len(pending)
+        return {'rows': rows, 'pending': pending, 'updated': datetime.now().isoformat()}
+
+    def update_state(self, df: pd.DataFrame, state: dict):
+        """Зафіксувати стан збірки для наступного запуску"""
+        self._save_state(self.collect_state(df, state))
+
+    def row_priority(self, row: pd.Series, previous_rows: dict) -> tuple:
+        """Менше - раніше: 0 - нові/змінені, 1 - закешовані, 2 - холодна генерація зображення"""
+        guid = self.row_uuid(row)
+        is_changed = previous_rows.get(guid) != self.row_fingerprint(row)
+        url = AssetManager.extract_url_from_tag(str(row.get('Image', '')))
+        # URL з негативного кешу пропускається миттєво - це не холодна генерація
+        cold_image = len(url) >= 5 and not self._check_cache(f"_img_{guid}.jpg") and not AssetManager.known_failure(url)
+        if is_changed:
+            # Серед нових/змінених дешеві (без холодного зображення) - першими
+            return (0, cold_image)
+        return (2 if cold_image else 1, False)
+
+    async def process_scheduled(self, df: pd.DataFrame, pbar, time_budget: float, previous_rows: dict):
+        """Обробити рядки в порядку пріоритету, зупинившись, коли вичерпано бюджет часу"""
+        rows = dict(df.iterrows())
+        queue = asyncio.PriorityQueue()
+        for order, (i, row) in enumerate(rows.items()):
+            queue.put_nowait((self.row_priority(row, previous_rows), order, i))
+
+        async def worker():
+            while True:
+                try: _, _, i = queue.get_nowait()
+                except asyncio.QueueEmpty: return
+                await self.process_row(i, rows[i], len(rows), pbar)
+
+        # Воркерів стільки, скільки може дозволити адаптивний семафор
+        workers = [asyncio.create_task(worker()) for _ in range(Config.CONCURRENCY * 2)]
+        remaining = time_budget - (time.time() - self.stats['start_time'])
+        _, unfinished = await asyncio.wait(workers, timeout=max(0, remaining))
+        if unfinished:
+            for task in unfinished: task.cancel()
+            await asyncio.gather(*unfinished, return_exceptions=True)
+            print(f"\n⏰ Бюджет часу {time_budget:g}с вичерпано - експортуємо те, що готово")
+
+    def reset_deck(self):
+        """Перезібрати колоду з self.notes після інкрементальних змін (--watch)"""
+        import genanki
+        records = [self.notes[guid] for guid in sorted(self.notes)]
+        confetti = AssetManager.get_path("_confetti.js")
+        self.deck = genanki.Deck(Config.DECK_ID, Config.DECK_NAME)
+        self.notes = {}
+        self.media_files = [confetti] if os.path.exists(confetti) else []
+        for record in records:
+            self.add_record(record)
+
     async def process_row(self, index: int, row: pd.Series, total: int, pbar):
         await asyncio.sleep(random.uniform(0.05, 0.2))
         async with self.semaphore:
@@ -594,10 +873,8 @@ class AnkiDeckBuilder:
                     return
 
                 clean_word = re.sub(Config.STRIP_REGEX, '', raw_word, flags=re.IGNORECASE).strip()
-                base_hash = hashlib.md5((clean_word + str(row.get('Part_of_Speech', ''))).encode()).hexdigest()
-                uuid = f"{base_hash}_{CURRENT_LANG}"
+                uuid = self.row_uuid(row)
                 
-                self.stats['words_processed'] += 1
                 print(f"[{index+1}/{total}] 🔄 Processing: {clean_word}...")
 
                 raw_context = str(row.get('ContextSentences', ''))
@@ -617,9 +894,11 @@ class AnkiDeckBuilder:
                 vid = Config.VOICE_ID
                 f_img = f"_img_{uuid}.jpg"
                 f_word = f"_word_{uuid}_{vid}_v54.mp3"
-                f_s1 = f"_sent_1_{uuid}_{vid}_v54.mp3"
-                f_s2 = f"_sent_2_{uuid}_{vid}_v54.mp3"
-                f_s3 = f"_sent_3_{uuid}_{vid}_v54.mp3"
+                # Хеш очищеного тексту в імені: відредаговане речення не візьме старе аудіо з кешу
+                f_s1, f_s2, f_s3 = (
+                    f"_sent_{n}_{uuid}_{vid}_{self.audio_text_hash(text)}_v54.mp3"
+                    for n, text in enumerate(sentences[:3], start=1)
+                )
 
                 tasks = []
                 
@@ -638,60 +917,70 @@ class AnkiDeckBuilder:
                     tasks.append(AssetManager.generate_audio(raw_word, f_word, volume="+40%"))
                     has_w_cached = False
                 
-                tasks.append(AssetManager.generate_audio(sentences[0], f_s1, volume="+0%") if sentences[0] else asyncio.sleep(0))
-                tasks.append(AssetManager.generate_audio(sentences[1], f_s2, volume="+0%") if sentences[1] else asyncio.sleep(0))
-                tasks.append(AssetManager.generate_audio(sentences[2], f_s3, volume="+0%") if sentences[2] else asyncio.sleep(0))
+                # Речення теж беремо з кешу - повністю закешований рядок не торкається TTS
+                sent_cached = [bool(text) and self._check_cache(f) for text, f in zip(sentences, (f_s1, f_s2, f_s3))]
+                for text, f, cached in zip(sentences, (f_s1, f_s2, f_s3), sent_cached):
+                    tasks.append(AssetManager.generate_audio(text, f, volume="+0%") if text and not cached else asyncio.sleep(0))
 
                 results = await asyncio.gather(*tasks)
                 has_img, has_w, has_s1, has_s2, has_s3 = results
+                # asyncio.sleep(0) повертає None - закешовані файли теж мають потрапити в нотатку
+                has_img = has_img or has_img_cached
+                has_w = has_w or has_w_cached
+                has_s1, has_s2, has_s3 = (bool(ok) or cached for ok, cached in zip((has_s1, has_s2, has_s3), sent_cached))
                 
                 # Оновити кеш і статистику
-                if has_img or has_img_cached:
+                if has_img:
                     self.stats['images_success'] += 1
-                    if has_img:
+                    if not has_img_cached:
                         self._update_cache(f_img)
                 else:
                     self.stats['images_failed'] += 1
                 
-                if has_w or has_w_cached:
+                if has_w:
                     self.stats['audio_word_success'] += 1
-                    if has_w:
+                    if not has_w_cached:
                         self._update_cache(f_word)
                 else:
                     self.stats['audio_word_failed'] += 1
                 
                 if has_s1:
                     self.stats['audio_sent_success'] += 1
-                    self._update_cache(f_s1)
+                    if not sent_cached[0]:
+                        self._update_cache(f_s1)
                 elif sentences[0]:
                     self.stats['audio_sent_failed'] += 1
                 
                 if has_s2:
                     self.stats['audio_sent_success'] += 1
-                    self._update_cache(f_s2)
+                    if not sent_cached[1]:
+                        self._update_cache(f_s2)
                 elif sentences[1]:
                     self.stats['audio_sent_failed'] += 1
                 
                 if has_s3:
                     self.stats['audio_sent_success'] += 1
-                    self._update_cache(f_s3)
+                    if not sent_cached[2]:
+                        self._update_cache(f_s3)
                 elif sentences[2]:
                     self.stats['audio_sent_failed'] += 1
 
-                if has_img: self.media_files.append(AssetManager.get_path(f_img))
-                if has_w: self.media_files.append(AssetManager.get_path(f_word))
-                if has_s1: self.media_files.append(AssetManager.get_path(f_s1))
-                if has_s2: self.media_files.append(AssetManager.get_path(f_s2))
-                if has_s3: self.media_files.append(AssetManager.get_path(f_s3))
+                media = [f for f, ok in ((f_img, has_img), (f_word, has_w), (f_s1, has_s1), (f_s2, has_s2), (f_s3, has_s3)) if ok]
+                # Чи отримано всі запитані медіа (невдалі рядки --watch повторює пізніше)
+                img_requested = len(AssetManager.extract_url_from_tag(str(row.get('Image', '')))) >= 5
+                complete = (has_img or not img_requested) and has_w and all(
+                    ok or not text for ok, text in zip((has_s1, has_s2, has_s3), sentences))
 
                 gender = "en" if CURRENT_LANG == "EN" else str(row.get('Gender', '')).strip().lower()
                 if not gender or gender == "nan": gender = "none"
                 
                 pbar.update(1)
 
-                note = genanki.Note(
-                    model=self.model,
-                    fields=[
+                # Рахуємо лише завершені рядки (скасовані --time-budget не потрапляють у статистику)
+                self.stats['words_processed'] += 1
+                self.add_record({
+                    'guid': uuid,
+                    'fields': [
                         str(row.get('TargetWord', '')), str(row.get('Meaning', '')), str(row.get('IPA', '')), 
                         str(row.get('Part_of_Speech', '')), gender, str(row.get('Morphology', '')), 
                         str(row.get('Nuance','')),
@@ -710,39 +999,54 @@ class AnkiDeckBuilder:
                         cloze_context,
                         uuid
                     ],
-                    tags=str(row.get('Tags', '')).split(), guid=uuid
-                )
-                self.deck.add_note(note)
+                    'tags': str(row.get('Tags', '')).split(),
+                    'media': media,
+                    'complete': bool(complete)
+                })
 
             except Exception as e:
                 print(f"⚠️ Error processing row {index}: {e}")
 
-    def export_package(self):
+    def export_package(self, timestamp: float = None):
         """Експортувати колоду з резервною копією та статистикою"""
         filename = f"ankitect_{CURRENT_LANG.lower()}.apkg"
-        valid_media = list(set([f for f in self.media_files if os.path.exists(f)]))
+        valid_media = sorted(set([f for f in self.media_files if os.path.exists(f)]))
         
         # Обчислити розмір файлів
         total_size = sum(os.path.getsize(f) for f in valid_media if os.path.exists(f))
         self.stats['total_bytes'] = total_size
         
-        # Резервна копія старого файлу
-        if os.path.exists(filename):
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            backup_filename = f"ankitect_{CURRENT_LANG.lower()}_{timestamp}.apkg"
-            shutil.copy2(filename, backup_filename)
-            print(f"💾 Резервна копія: {backup_filename}")
-        
-        # Створити пакет
+        # Створити пакет у тимчасовому файлі - при помилці запису старий .apkg лишається на місці
+        import genanki
         package = genanki.Package(self.deck)
         package.media_files = valid_media
-        package.write_to_file(filename)
+        tmp_filename = f"{filename}.{os.getpid()}.tmp"
+        try:
+            package.write_to_file(tmp_filename, timestamp=timestamp)
+        except:
+            if os.path.exists(tmp_filename): os.remove(tmp_filename)
+            raise
+
+        # Резервна копія старого файлу: жорстке посилання миттєве, знімок робиться у фоні
+        pending = None
+        if os.path.exists(filename) and self.backups_enabled:
+            timestamp_str = datetime.now().strftime("%Y%m%d_%H%M%S")
+            backup_name = f"ankitect_{CURRENT_LANG.lower()}_{timestamp_str}"
+            pending = BackupStore().stage(filename, backup_name)
+        try:
+            os.replace(tmp_filename, filename)
+        except:
+            os.remove(tmp_filename)
+            if pending: os.remove(pending)
+            raise
         
         # Показати детальну статистику
         self._print_statistics(filename, total_size)
         
-        # Прибрати старі резервні копії (залишити останні 3)
-        self._cleanup_old_backups()
+        # Знімок + прибирання старих резервних копій (залишити останні 3) не блокують експорт
+        if pending:
+            BackupStore().snapshot_async(pending, backup_name)
+            print(f"💾 Резервна копія: {backup_name} (у фоні)")
 
     def _print_statistics(self, filename: str, total_size: int):
         """Показати детальний звіт статистики"""
@@ -771,6 +1075,8 @@ class AnkiDeckBuilder:
         print(f"📦 Розмір медіа:              {size_mb:.1f} МБ")
         print(f"💾 Розмір файлу:             {file_size:.1f} МБ")
         print(f"📝 Файл створено:            {filename}")
+        if self.stats.get('rows_pending'):
+            print(f"⏳ Відкладено на наступний запуск: {self.stats['rows_pending']} (див. {self.STATE_FILE})")
         
         # Адаптивна паралелізація статистика
         if self.adaptive_stats['concurrency_adjustments'] > 0:
@@ -780,43 +1086,672 @@ class AnkiDeckBuilder:
         
         print("="*60)
 
-    def _cleanup_old_backups(self, keep_count: int = 3):
-        """Видалити старі резервні копії, залишити тільки останні N"""
-        pattern = f"ankitect_{CURRENT_LANG.lower()}_*.apkg"
-        backups = sorted(Path('.').glob(pattern), key=os.path.getmtime, reverse=True)
-        
-        for old_backup in backups[keep_count:]:
+# --- BACKUP STORE ---
+class BackupStore:
+    """Резервні копії .apkg як маніфести над content-addressed блоками (sha256).
+    Незмінені медіафайли між збірками зберігаються лише один раз."""
+    CHUNK_SIZE = 1024 * 1024
+    KEEP_COUNT = 3
+    _executor = None
+    _queued = set()  # pending-файли, для яких знімок уже в черзі
+
+    def __init__(self, root: str = None):
+        self.root = root or Config.BACKUP_DIR
+        self.objects_dir = os.path.join(self.root, "objects")
+        self.snapshots_dir = os.path.join(self.root, "snapshots")
+
+    def _object_path(self, digest: str) -> str:
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    def _put(self, data: bytes) -> str:
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._object_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as f: f.write(data)
+            os.replace(tmp_path, path)
+        return digest
+
+    def stage(self, apkg_path: str, name: str) -> str:
+        """Миттєво зберегти старий .apkg (жорстке посилання) перед заміною новим пакетом"""
+        os.makedirs(self.root, exist_ok=True)
+        pending = os.path.join(self.root, f"{name}.pending.apkg")
+        try:
+            os.link(apkg_path, pending)
+        except OSError:
+            # ФС без жорстких посилань - звичайна копія
+            shutil.copy2(apkg_path, pending)
+        return pending
+
+    def snapshot(self, apkg_path: str, name: str) -> str:
+        """Розкласти .apkg на блоки і записати маніфест знімка"""
+        members = []
+        with zipfile.ZipFile(apkg_path) as zf:
+            for info in zf.infolist():
+                chunks = []
+                with zf.open(info) as f:
+                    while True:
+                        data = f.read(self.CHUNK_SIZE)
+                        if not data: break
+                        chunks.append(self._put(data))
+                members.append({'name': info.filename, 'compress_type': info.compress_type,
+                                'size': info.file_size, 'chunks': chunks})
+        os.makedirs(self.snapshots_dir, exist_ok=True)
+        path = os.path.join(self.snapshots_dir, f"{name}.json")
+        with open(path + ".tmp", 'w', encoding='utf-8') as f:
+            json.dump({'name': name, 'created': time.time(), 'members': members}, f)
+        os.replace(path + ".tmp", path)
+        return path
+
+    def _snapshot_and_prune(self, pending: str, name: str):
+        try:
+            self.snapshot(pending, name)
+            os.remove(pending)
+            self.migrate_leftovers()
+            self.prune()
+        except Exception as e:
+            print(f"⚠️ Помилка резервної копії {name}: {e} (файл збережено: {pending})")
+        finally:
+            BackupStore._queued.discard(os.path.abspath(pending))
+
+    def migrate_leftovers(self):
+        """Перенести в сховище незавершені знімки (*.pending.apkg після збою) і - один раз -
+        старі повні копії ankitect_<lang>_YYYYMMDD_HHMMSS.apkg з кореня проєкту"""
+        leftovers = [(p, p.name[:-len(".pending.apkg")]) for p in Path(self.root).glob("*.pending.apkg")
+                     if str(p.resolve()) not in BackupStore._queued]
+        marker = os.path.join(self.root, f".legacy_migrated_{CURRENT_LANG.lower()}")
+        if not os.path.exists(marker):
+            pattern = re.compile(rf"ankitect_{CURRENT_LANG.lower()}_\d{{8}}_\d{{6}}\.apkg")
+            leftovers += [(p, p.stem) for p in Path('.').glob(f"ankitect_{CURRENT_LANG.lower()}_*.apkg") if pattern.fullmatch(p.name)]
+            with open(marker, 'w', encoding='utf-8') as f: f.write(datetime.now().isoformat())
+        for path, name in leftovers:
             try:
-                old_backup.unlink()
-            except:
-                pass
+                self.snapshot(str(path), name)
+                path.unlink()
+            except Exception as e:
+                print(f"⚠️ Не вдалося перенести {path}: {e}")
+
+    def snapshot_async(self, pending: str, name: str):
+        # Один фоновий потік: знімки серіалізовані, процес дочекається їх при виході
+        if BackupStore._executor is None:
+            BackupStore._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="backup")
+        BackupStore._queued.add(os.path.abspath(pending))
+        return BackupStore._executor.submit(self._snapshot_and_prune, pending, name)
+
+    def list_snapshots(self) -> list:
+        """Знімки поточної мови, від найстаршого до найновішого"""
+        prefix = f"ankitect_{CURRENT_LANG.lower()}_"
+        if not os.path.isdir(self.snapshots_dir): return []
+        return sorted(f[:-5] for f in os.listdir(self.snapshots_dir) if f.startswith(prefix) and f.endswith(".json"))
+
+    def prune(self, keep_count: int = None):
+        """Видалити старі знімки, залишити тільки останні N, і прибрати блоки без посилань"""
+        keep_count = self.KEEP_COUNT if keep_count is None else keep_count
+        for name in self.list_snapshots()[:-keep_count or None]:
+            try: os.remove(os.path.join(self.snapshots_dir, f"{name}.json"))
+            except: pass
+
+        referenced = set()
+        for manifest_file in os.listdir(self.snapshots_dir):
+            if not manifest_file.endswith(".json"): continue
+            with open(os.path.join(self.snapshots_dir, manifest_file), 'r', encoding='utf-8') as f:
+                for member in json.load(f)['members']:
+                    referenced.update(member['chunks'])
+        for obj in Path(self.objects_dir).glob("*/*"):
+            if obj.name not in referenced:
+                try: obj.unlink()
+                except: pass
+
+    def restore(self, name: str = None, output: str = None) -> str:
+        """Зібрати повний .apkg зі знімка (за замовчуванням - найновішого)"""
+        snapshots = self.list_snapshots()
+        if not snapshots:
+            print(f"❌ Немає знімків у {self.snapshots_dir}")
+            return None
+        name = name or snapshots[-1]
+        if name not in snapshots:
+            print(f"❌ Знімок не знайдено: {name}. Доступні: {', '.join(snapshots)}")
+            return None
+        with open(os.path.join(self.snapshots_dir, f"{name}.json"), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        # Суфікс .restored - відновлений файл не сплутати зі старою повною копією при міграції
+        output = output or f"{name}.restored.apkg"
+        with zipfile.ZipFile(output, 'w') as zf:
+            for member in manifest['members']:
+                info = zipfile.ZipInfo(member['name'])
+                info.compress_type = member['compress_type']
+                with zf.open(info, 'w') as out:
+                    for digest in member['chunks']:
+                        with open(self._object_path(digest), 'rb') as f: out.write(f.read())
+        print(f"♻️ Відновлено: {output}")
+        return output
+
+# --- ANKICONNECT DELTA SYNC ---
+class AnkiConnectSync:
+    """Доставка змін у запущений Anki через AnkiConnect замість повного імпорту .apkg.
+    Нотатки зіставляються за полем UUID (воно ж GUID нотатки)."""
+
+    def __init__(self, builder: 'AnkiDeckBuilder', url: str = None):
+        self.builder = builder
+        self.url = url or Config.ANKICONNECT_URL
+        self.model_name = builder.model.name
+        self.field_names = [f['name'] for f in builder.model.fields]
+        self.session = None
+
+    async def invoke(self, action: str, **params):
+        payload = {'action': action, 'version': 6, 'params': params}
+        async with self.session.post(self.url, json=payload) as response:
+            reply = await response.json(content_type=None)
+        if reply.get('error'):
+            raise RuntimeError(f"AnkiConnect {action}: {reply['error']}")
+        return reply.get('result')
+
+    async def invoke_batched(self, action: str, items: list, make_params) -> int:
+        """Виконати action для items пачками через multi; повертає кількість успішних"""
+        succeeded = 0
+        for start in range(0, len(items), Config.ANKICONNECT_BATCH):
+            batch = items[start:start + Config.ANKICONNECT_BATCH]
+            # version у кожній дії: без неї AnkiConnect відповідає у форматі v4 і помилки стають null
+            replies = await self.invoke('multi', actions=[
+                {'action': action, 'version': 6, 'params': make_params(item)} for item in batch])
+            for reply in replies:
+                if not isinstance(reply, dict) or 'error' not in reply:
+                    print(f"   ⚠️ {action}: неочікувана відповідь {reply!r}")
+                elif reply['error']:
+                    print(f"   ⚠️ {action}: {reply['error']}")
+                elif action == 'addNote' and reply.get('result') is None:
+                    print(f"   ⚠️ {action}: нотатку не створено")
+                else:
+                    succeeded += 1
+        return succeeded
+
+    async def _ensure_model_and_deck(self):
+        if self.model_name not in await self.invoke('modelNames'):
+            model = self.builder.model
+            await self.invoke('createModel',
+                modelName=self.model_name,
+                inOrderFields=self.field_names,
+                css=model.css,
+                cardTemplates=[{'Name': t['name'], 'Front': t['qfmt'], 'Back': t['afmt']} for t in model.templates])
+            print(f"🧱 Створено тип нотаток: {self.model_name}")
+        await self.invoke('createDeck', deck=Config.DECK_NAME)
+
+    async def _existing_notes(self) -> dict:
+        """UUID -> (noteId, поля, теги) для нотаток цієї моделі в колекції"""
+        note_ids = await self.invoke('findNotes', query=f'"note:{self.model_name}"')
+        existing = {}
+        for start in range(0, len(note_ids), Config.ANKICONNECT_BATCH):
+            for info in await self.invoke('notesInfo', notes=note_ids[start:start + Config.ANKICONNECT_BATCH]):
+                fields = {name: value['value'] for name, value in info.get('fields', {}).items()}
+                if fields.get('UUID'):
+                    existing[fields['UUID']] = (info['noteId'], fields, sorted(info.get('tags', [])))
+        return existing
+
+    async def _push_media(self) -> int:
+        present = set(await self.invoke('getMediaFilesNames', pattern='_*'))
+        missing = sorted({p for p in self.builder.media_files if os.path.exists(p) and os.path.basename(p) not in present})
+
+        def store_params(path):
+            with open(path, 'rb') as f:
+                return {'filename': os.path.basename(path), 'data': base64.b64encode(f.read()).decode('ascii')}
+
+        stored = await self.invoke_batched('storeMediaFile', missing, store_params)
+        return stored, len(missing) - stored
+
+    async def sync(self):
+        import aiohttp
+        timeout = aiohttp.ClientTimeout(total=Config.TIMEOUT)
+        try:
+            async with aiohttp.ClientSession(timeout=timeout) as session:
+                self.session = session
+                await self._ensure_model_and_deck()
+                existing = await self._existing_notes()
+
+                added, changed = [], []
+                for guid in sorted(self.builder.notes):
+                    record = self.builder.notes[guid]
+                    fields = dict(zip(self.field_names, record['fields']))
+                    if guid not in existing:
+                        added.append((fields, record['tags']))
+                        continue
+                    note_id, old_fields, old_tags = existing[guid]
+                    if old_fields != fields or old_tags != sorted(record['tags']):
+                        changed.append((note_id, fields, record['tags']))
+
+                media_stored, media_failed = await self._push_media()
+                added_ok = await self.invoke_batched('addNote', added, lambda item: {'note': {
+                    'deckName': Config.DECK_NAME, 'modelName': self.model_name,
+                    'fields': item[0], 'tags': item[1], 'options': {'allowDuplicate': True}}})
+                changed_ok = await self.invoke_batched('updateNote', changed, lambda item: {'note': {
+                    'id': item[0], 'fields': item[1], 'tags': item[2]}})
+        except (aiohttp.ClientError, asyncio.TimeoutError, RuntimeError) as e:
+            print(f"❌ AnkiConnect Error ({self.url}): {e}")
+            return False
+        finally:
+            self.session = None
+
+        failed = (len(added) - added_ok) + (len(changed) - changed_ok) + media_failed
+        print(f"🔁 AnkiConnect: +{added_ok} нових, ~{changed_ok} змінених, "
+              f"{len(self.builder.notes) - len(added) - len(changed)} без змін, {media_stored} медіафайлів"
+              + (f", ❌ {failed} з помилкою" if failed else ""))
+        return failed == 0
+
+async def deliver(builder: 'AnkiDeckBuilder', sync_url: str = None, timestamp: float = None):
+    """Експорт у .apkg або, з --sync, лише дельта через AnkiConnect"""
+    if sync_url:
+        return await AnkiConnectSync(builder, sync_url).sync()
+    builder.export_package(timestamp=timestamp)
+    return True
+
+# --- SHARDING ---
+class ShardManager:
+    """Шардинг збірки за GUID: кожен воркер (процес або машина) обробляє свою частку рядків
+    у спільну теку media/ і пише частковий маніфест нотаток; злиття збирає один .apkg."""
+
+    @staticmethod
+    def parse_spec(spec: str) -> tuple:
+        """'2/8' -> (2, 8)"""
+        match = re.fullmatch(r'\s*(\d+)\s*/\s*(\d+)\s*', spec)
+        if not match:
+            raise argparse.ArgumentTypeError(f"очікується формат I/N, отримано: {spec!r}")
+        index, count = int(match.group(1)), int(match.group(2))
+        if count < 1 or index >= count:
+            raise argparse.ArgumentTypeError(f"некоректний шард: {spec!r}")
+        return index, count
+
+    @staticmethod
+    def shard_of(uuid: str, count: int) -> int:
+        # uuid = md5-hex + мова, тому перші 8 символів рівномірно розподілені
+        return int(uuid[:8], 16) % count
+
+    @staticmethod
+    def manifest_path(index: int, count: int) -> str:
+        return os.path.join(Config.SHARD_DIR, f"ankitect_{CURRENT_LANG.lower()}_shard{index}of{count}.json")
 
-async def main():
+    @staticmethod
+    def cache_path(index: int, count: int) -> str:
+        return os.path.join(Config.SHARD_DIR, f"build_cache_shard{index}of{count}.json")
+
+    @staticmethod
+    def negative_cache_path(index: int, count: int) -> str:
+        return os.path.join(Config.SHARD_DIR, f"negative_cache_shard{index}of{count}.json")
+
+    @staticmethod
+    def write_manifest(builder: 'AnkiDeckBuilder', index: int, count: int, state: dict = None, csv_digest: str = None):
+        """Записати частковий маніфест шарда (атомарно, через тимчасовий файл)"""
+        os.makedirs(Config.SHARD_DIR, exist_ok=True)
+        path = ShardManager.manifest_path(index, count)
+        manifest = {
+            'lang': CURRENT_LANG,
+            'model_id': Config.MODEL_ID,
+            'deck_id': Config.DECK_ID,
+            'shard': [index, count],
+            'csv_digest': csv_digest,
+            'built_at': time.time(),
+            'stats': {k: v for k, v in builder.stats.items() if k != 'start_time'},
+            'notes': [builder.notes[guid] for guid in sorted(builder.notes)],
+            'state': state or {'rows': {}, 'pending': []},
+        }
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        print(f"🧩 Шард {index}/{count}: {len(manifest['notes'])} нотаток → {path}")
+
+    @staticmethod
+    async def merge(count: int, start_time: float = None, sync_url: str = None):
+        """Зібрати маніфести всіх шардів в один детермінований .apkg"""
+        manifests = []
+        for index in range(count):
+            path = ShardManager.manifest_path(index, count)
+            if not os.path.exists(path):
+                print(f"❌ Відсутній маніфест шарда: {path}")
+                return
+            with open(path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            if (manifest['model_id'], manifest['deck_id']) != (Config.MODEL_ID, Config.DECK_ID):
+                print(f"❌ Маніфест {path} зібрано з іншими MODEL_ID/DECK_ID")
+                return
+            if manifest.get('shard') != [index, count]:
+                print(f"❌ Маніфест {path} належить іншому розбиттю: {manifest.get('shard')}")
+                return
+            manifests.append(manifest)
+
+        # Усі шарди мають бути зібрані з того самого vocabulary.csv, що лежить тут -
+        # залишки попереднього запуску повернули б видалені чи старі версії нотаток
+        digests = {m.get('csv_digest') for m in manifests}
+        expected = csv_digest()
+        if len(digests) != 1 or None in digests or (expected and digests != {expected}):
+            print(f"❌ Маніфести шардів зібрано з різних або застарілих версій {Config.CSV_FILE} - перезапустіть шарди")
+            return
+
+        builder = AnkiDeckBuilder()
+        if start_time:
+            builder.stats['start_time'] = start_time
+        await builder._download_confetti_lib()
+
+        records = {}
+        for manifest in manifests:
+            for key, value in manifest['stats'].items():
+                builder.stats[key] = builder.stats.get(key, 0) + value
+            for record in manifest['notes']:
+                records[record['guid']] = record
+        # Фіксований порядок нотаток і медіа - результат не залежить від кількості шардів
+        for guid in sorted(records):
+            builder.add_record(records[guid])
+
+        # Злити кеші шардів у спільний build_cache.json
+        for index in range(count):
+            shard_cache = ShardManager.cache_path(index, count)
+            if os.path.exists(shard_cache):
+                try:
+                    with open(shard_cache, 'r', encoding='utf-8') as f:
+                        builder.cache.update(json.load(f))
+                    os.remove(shard_cache)
+                except:
+                    pass
+        builder._save_cache()
+
+        # Злити негативні кеші шардів: перемагає запис із пізнішим терміном дії
+        negative = AssetManager.read_negative_file(AssetManager.NEGATIVE_CACHE_FILE)
+        for index in range(count):
+            shard_negative = ShardManager.negative_cache_path(index, count)
+            for url, entry in AssetManager.read_negative_file(shard_negative).items():
+                if url not in negative or entry['until'] > negative[url]['until']:
+                    negative[url] = entry
+            if os.path.exists(shard_negative):
+                try: os.remove(shard_negative)
+                except: pass
+        AssetManager.write_negative_file(AssetManager.NEGATIVE_CACHE_FILE, negative)
+        AssetManager._negative = negative
+
+        # Стан збірки: шарди не перетинаються, тож достатньо об'єднати
+        state = {'rows': {}, 'pending': [], 'updated': datetime.now().isoformat()}
+        for manifest in manifests:
+            shard_state = manifest.get('state', {})
+            state['rows'].update(shard_state.get('rows', {}))
+            state['pending'].extend(shard_state.get('pending', []))
+        builder._save_state(state)
+
+        print(f"🧩 Злито шардів: {count}, нотаток: {len(records)}")
+        if await deliver(builder, sync_url, timestamp=max(m['built_at'] for m in manifests)):
+            # Маніфести використано - прибрати, щоб наступне злиття не підхопило їх повторно
+            for index in range(count):
+                try: os.remove(ShardManager.manifest_path(index, count))
+                except OSError: pass
+
+    @staticmethod
+    async def run_workers(count: int, sync_url: str = None, time_budget: float = None):
+        """Локально запустити N процесів-шардів над спільною текою media/ і злити результат"""
+        start_time = time.time()
+        print(f"🚀 Запуск {count} воркерів...")
+        extra_args = ['--time-budget', str(time_budget)] if time_budget else []
+        procs = [
+            await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), '--shard', f"{index}/{count}", *extra_args)
+            for index in range(count)
+        ]
+        codes = await asyncio.gather(*(proc.wait() for proc in procs))
+        failed = [index for index, code in enumerate(codes) if code != 0]
+        if failed:
+            print(f"❌ Воркери завершились з помилкою: {failed}")
+            return
+        await ShardManager.merge(count, start_time=start_time, sync_url=sync_url)
+
+def csv_digest():
+    """sha256 вмісту vocabulary.csv (None, якщо файлу немає)"""
+    if not os.path.exists(Config.CSV_FILE):
+        return None
+    with open(Config.CSV_FILE, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def load_vocabulary():
     if not os.path.exists(Config.CSV_FILE):
         print(f"❌ Error: {Config.CSV_FILE} not found!")
-        return
+        return None
     try:
-        print(f"🎤 Voice Selected: {Config.VOICE}")
-        print(f"🌍 Mode: {CURRENT_LANG}")
+        import pandas as pd
         df = pd.read_csv(Config.CSV_FILE, sep='|', encoding='utf-8-sig').fillna('')
-        print("🎲 Shuffling words...")
-        df = df.sample(frac=1).reset_index(drop=True)
         df.columns = df.columns.str.strip()
+        return df
     except Exception as e:
-        print(f"❌ CSV Error: {e}"); return
+        print(f"❌ CSV Error: {e}")
+        return None
+
+async def main(shard: tuple = None, sync_url: str = None, time_budget: float = None):
+    print(f"🎤 Voice Selected: {Config.VOICE}")
+    print(f"🌍 Mode: {CURRENT_LANG}")
+    digest = csv_digest()
+    df = load_vocabulary()
+    if df is None:
+        return
+
+    if shard:
+        index, count = shard
+        mask = df.apply(lambda row: ShardManager.shard_of(AnkiDeckBuilder.row_uuid(row), count) == index, axis=1)
+        df = df[mask.astype(bool)] if len(df) else df
+        builder = AnkiDeckBuilder(cache_file=ShardManager.cache_path(index, count))
+        os.makedirs(Config.SHARD_DIR, exist_ok=True)
+        AssetManager._negative_file = ShardManager.negative_cache_path(index, count)
+    else:
+        builder = AnkiDeckBuilder()
+
+    # З --time-budget конфеті качається паралельно з рядками в межах того ж бюджету,
+    # інакше повільний CDN може з'їсти весь час ще до першого рядка
+    confetti = None
+    if not shard:
+        if time_budget:
+            confetti = asyncio.ensure_future(builder._download_confetti_lib())
+        else:
+            await builder._download_confetti_lib()
 
-    builder = AnkiDeckBuilder()
-    await builder._download_confetti_lib()
+    print("🎲 Shuffling words...")
+    df = df.sample(frac=1).reset_index(drop=True)
     
     # Прогрес-бар з tqdm
+    from tqdm.asyncio import tqdm as atqdm
     print(f"📚 Processing {len(df)} words...\n")
     
+    state = builder._load_state()
     with atqdm(total=len(df), desc="Building deck", unit="word") as pbar:
-        tasks = [builder.process_row(i, row, len(df), pbar) for i, row in df.iterrows()]
-        await asyncio.gather(*tasks)
+        if time_budget:
+            await builder.process_scheduled(df, pbar, time_budget, state['rows'])
+            if confetti:
+                remaining = time_budget - (time.time() - builder.stats['start_time'])
+                try:
+                    await asyncio.wait_for(confetti, timeout=max(0, remaining))
+                except asyncio.TimeoutError:
+                    print("⏰ _confetti.js не встиг завантажитись - колода без конфеті")
+        else:
+            tasks = [builder.process_row(i, row, len(df), pbar) for i, row in df.iterrows()]
+            await asyncio.gather(*tasks)
     
-    builder.export_package()
+    if shard:
+        # Стан шарда (відбитки + відкладені рядки) зливається в build_state.json при --merge
+        ShardManager.write_manifest(builder, *shard, state=builder.collect_state(df, state), csv_digest=digest)
+    else:
+        builder.update_state(df, state)
+        await deliver(builder, sync_url)
+
+# --- WATCH MODE ---
+class VocabularyWatcher:
+    """Довгоживучий процес: тримає кеш, модель, HTTP-пул і набір нотаток у пам'яті
+    та після кожного збереження vocabulary.csv перезбирає лише змінені рядки."""
+
+    def __init__(self, sync_url: str = None):
+        self.sync_url = sync_url
+        self.builder = None
+        self.needs_retry = False  # є рядки з недоотриманими медіа
+        self.export_pending = False  # колода змінилась, але доставка не вдалася
+
+    @staticmethod
+    def _signature():
+        try:
+            st = os.stat(Config.CSV_FILE)
+            return st.st_mtime_ns, st.st_size
+        except OSError:
+            return None
+
+    async def rebuild(self):
+        from tqdm.asyncio import tqdm as atqdm
+        df = load_vocabulary()
+        if df is None:
+            return
+        builder = self.builder
+
+        rows = {}
+        for _, row in df.iterrows():
+            if not str(row.get('TargetWord', '')).strip(): continue
+            rows[AnkiDeckBuilder.row_uuid(row)] = (row, AnkiDeckBuilder.row_fingerprint(row))
+        changed = [guid for guid, (_, fp) in rows.items() if builder.row_hashes.get(guid) != fp]
+        removed = [guid for guid in builder.notes if guid not in rows]
+        if not changed and not removed and not self.export_pending:
+            print("💤 Без змін у нотатках")
+            return
+
+        for guid in removed:
+            builder.notes.pop(guid, None)
+            builder.row_hashes.pop(guid, None)
+        builder.reset_stats()
+        before = {guid: builder.notes.get(guid) for guid in changed}
+        print(f"📝 Змінено: {len(changed)}, видалено: {len(removed)}, без змін: {len(rows) - len(changed)}")
+        with atqdm(total=len(changed), desc="Rebuilding", unit="word") as pbar:
+            await asyncio.gather(*(builder.process_row(i, rows[guid][0], len(changed), pbar) for i, guid in enumerate(changed)))
+        # Відбиток фіксуємо лише для рядків, де отримано всі медіа - решта повториться пізніше
+        # (пропущені через негативний кеш підуть у мережу, щойно закінчиться TTL)
+        for guid in changed:
+            record = builder.notes.get(guid)
+            if record is not before[guid] and record.get('complete', True):
+                builder.row_hashes[guid] = rows[guid][1]
+        self.needs_retry = any(guid not in builder.row_hashes for guid in rows)
+
+        self.export_pending = True
+        builder.reset_deck()
+        self.export_pending = not await deliver(builder, self.sync_url)
+        if not self.export_pending:
+            # Колода до початку сесії вже збережена - наступні збереження не витісняють її з 3 знімків
+            if not self.sync_url:
+                builder.backups_enabled = False
+            # Відбитки для --time-budget: наступний звичайний запуск бачить актуальний стан
+            builder.update_state(df, builder._load_state())
+
+    async def safe_rebuild(self, reason: str):
+        """Перезбирання, помилка якого не зупиняє демон (напр. .apkg заблоковано Anki у Windows)"""
+        print(f"\n🔔 {reason}, перезбирання...")
+        started = time.time()
+        try:
+            await self.rebuild()
+            print(f"⚡ Готово за {time.time() - started:.1f}с")
+        except Exception as e:
+            self.export_pending = True
+            print(f"❌ Перезбирання не вдалося: {e!r} - повтор після наступної зміни або за {Config.WATCH_RETRY_INTERVAL:g}с")
+
+    async def run(self):
+        print(f"👀 Watch mode: {Config.CSV_FILE} (Ctrl+C to stop)")
+        self.builder = AnkiDeckBuilder()
+        await AssetManager.open_session()
+        try:
+            await self.builder._download_confetti_lib()
+            last = self._signature()
+            await self.safe_rebuild("Старт")
+            last_attempt = time.time()
+            while True:
+                await asyncio.sleep(Config.WATCH_INTERVAL)
+                current = self._signature()
+                if current == last:
+                    if (self.needs_retry or self.export_pending) and time.time() - last_attempt >= Config.WATCH_RETRY_INTERVAL:
+                        await self.safe_rebuild("Повтор незавершених рядків")
+                        last_attempt = time.time()
+                    continue
+                # Debounce: редактори зберігають файл кількома записами - чекаємо, поки він стабілізується
+                while True:
+                    await asyncio.sleep(Config.WATCH_DEBOUNCE)
+                    settled = self._signature()
+                    if settled == current: break
+                    current = settled
+                last = current
+                await self.safe_rebuild(f"{Config.CSV_FILE} змінено")
+                last_attempt = time.time()
+        finally:
+            await AssetManager.close_session()
+
+# --- STARTUP BENCHMARK ---
+HEAVY_MODULES = ('pandas', 'genanki', 'edge_tts', 'aiohttp', 'tqdm')
+
+def startup_report(budget_ms: int = None) -> bool:
+    """Звіт у стилі -X importtime для `import build_deck`: найдорожчі модулі та перевірка,
+    що важкі залежності не імпортуються на старті і час імпорту вкладається в бюджет"""
+    import subprocess
+    budget_ms = budget_ms or Config.STARTUP_BUDGET_MS
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import build_deck'],
+                          cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+    if proc.returncode != 0:
+        print(f"❌ Import failed:\n{proc.stderr[-2000:]}")
+        return False
+
+    entries = []  # (self_us, cumulative_us, module)
+    for line in proc.stderr.splitlines():
+        match = re.match(r'import time:\s+(\d+)\s+\|\s+(\d+)\s+\|\s*(\S+)', line)
+        if match: entries.append((int(match.group(1)), int(match.group(2)), match.group(3)))
+    own_ms = next((cum for _, cum, name in entries if name == 'build_deck'), 0) / 1000
+    total_ms = sum(self_us for self_us, _, _ in entries) / 1000
+    heavy = sorted({name.split('.')[0] for _, _, name in entries if name.split('.')[0] in HEAVY_MODULES})
+
+    print("\n" + "="*60)
+    print("⏱️  STARTUP IMPORT REPORT")
+    print("="*60)
+    for self_us, cum, name in sorted(entries, key=lambda e: e[1], reverse=True)[:10]:
+        print(f"{cum / 1000:8.1f} ms  (self {self_us / 1000:6.1f} ms)  {name}")
+    print("-"*60)
+    print(f"📦 import build_deck:       {own_ms:.1f} ms (budget {budget_ms} ms)")
+    print(f"🧮 All imports:             {total_ms:.1f} ms, {len(entries)} modules")
+    print(f"🐢 Heavy modules on start:  {', '.join(heavy) if heavy else 'none'}")
+    print("="*60)
+    return not heavy and own_ms <= budget_ms
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="AnkiTect: Intelligent Anki Deck Generator")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--workers', type=int, metavar='N',
+                      help="розбити збірку на N локальних процесів і злити результат")
+    mode.add_argument('--shard', type=ShardManager.parse_spec, metavar='I/N',
+                      help="обробити лише шард I з N і записати частковий маніфест")
+    mode.add_argument('--merge', type=int, metavar='N',
+                      help="злити маніфести N шардів в один .apkg")
+    mode.add_argument('--watch', action='store_true',
+                      help="залишитись у фоні й перезбирати колоду після кожної зміни vocabulary.csv")
+    mode.add_argument('--restore', nargs='?', const='', metavar='SNAPSHOT',
+                      help="відновити .apkg зі знімка резервної копії (за замовч. найновішого)")
+    parser.add_argument('--time-budget', type=float, metavar='SECONDS',
+                        help="обробляти рядки за пріоритетом і експортувати готове, коли час вичерпано "
+                             "(звичайна збірка, --workers, --shard)")
+    parser.add_argument('--startup-report', action='store_true',
+                        help="показати звіт -X importtime і завершитись з кодом 1 при регресії старту")
+    parser.add_argument('--sync', nargs='?', const=Config.ANKICONNECT_URL, metavar='URL',
+                        help=f"замість .apkg надіслати лише зміни в Anki через AnkiConnect (за замовч. {Config.ANKICONNECT_URL})")
+    args = parser.parse_args(argv)
+    if args.time_budget is not None:
+        if args.time_budget <= 0:
+            parser.error("--time-budget має бути додатним")
+        if args.merge or args.watch or args.restore is not None:
+            parser.error("--time-budget не можна поєднувати з --merge, --watch або --restore")
+    return args
+
+async def run(args):
+    if args.restore is not None:
+        BackupStore().restore(args.restore or None)
+    elif args.workers and args.workers > 1:
+        await ShardManager.run_workers(args.workers, sync_url=args.sync, time_budget=args.time_budget)
+    elif args.merge:
+        await ShardManager.merge(args.merge, sync_url=args.sync)
+    elif args.watch:
+        await VocabularyWatcher(sync_url=args.sync).run()
+    else:
+        await main(shard=args.shard, sync_url=args.sync, time_budget=args.time_budget)
 
 if __name__ == "__main__":
-    try: asyncio.run(main())
-    except KeyboardInterrupt: print("\n🛑 Aborted by user.")
\ No newline at end of file
+    args = parse_args()
+    if args.startup_report:
+        sys.exit(0 if startup_report() else 1)
+    try: asyncio.run(run(args))
+    except KeyboardInterrupt: print("\n🛑 Aborted by user.")